@@ -4,9 +4,18 @@ Streamlit-based interface with chat history and database persistence.
 """
 
 import streamlit as st
-from rag import RAGChatbot, check_ollama_status
+from rag import RAGChatbot, check_ollama_status, history_from_messages, new_history, MAX_HISTORY_MESSAGES
 import database as db
+from collections import defaultdict
 from datetime import datetime
+from typing import List, Dict, Optional
+
+# Source card markup; missing fields render as N/A
+_SRC_TPL = (
+    '<div class="source-card"><strong>🏛️ {site}</strong><br>'
+    '📍 {ville} | 📅 {periode} | 📖 {source}{relevance}</div>'
+)
+_RELEVANCE_TPL = "<br>🎯 Pertinence: {:.0%}"
 
 # ==================== PAGE CONFIG ====================
 
@@ -74,34 +83,142 @@ st.markdown("""
 
 # ==================== SESSION STATE ====================
 
+@st.cache_resource
+def get_chatbot() -> RAGChatbot:
+    """Shared chatbot instance (ChromaDB client + embedding model) for all sessions."""
+    return RAGChatbot()
+
 def init_session_state():
     """Initialize session state variables."""
-    if "chatbot" not in st.session_state:
-        st.session_state.chatbot = RAGChatbot()
-    if "current_chat_id" not in st.session_state:
-        st.session_state.current_chat_id = None
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    if "show_sources" not in st.session_state:
-        st.session_state.show_sources = True
+    st.session_state.chatbot = get_chatbot()
+    st.session_state.setdefault("current_chat_id", None)
+    st.session_state.setdefault("messages", [])
+    st.session_state.setdefault("history", new_history())
+    st.session_state.setdefault("show_sources", True)
+    st.session_state.setdefault("chat_page_offset", 0)
+    st.session_state.setdefault("chat_search", "")
 
 init_session_state()
 
+# ==================== CACHED QUERIES ====================
+
+CHATS_PAGE_SIZE = 50
+
+@st.cache_data(ttl=60)
+def get_chats_page_cached(search: Optional[str], offset: int) -> List[Dict]:
+    """One page of the sidebar chat list, shared by all sessions until invalidated."""
+    return db.get_chats_page(search, limit=CHATS_PAGE_SIZE, offset=offset)
+
+@st.cache_data(ttl=60)
+def get_stats_cached() -> Dict:
+    """Database statistics, shared by all sessions until invalidated."""
+    return db.get_stats()
+
+@st.cache_data(ttl=10)
+def cached_ollama_status() -> Dict:
+    """Ollama health probe, refreshed at most every 10 seconds."""
+    return check_ollama_status()
+
+@st.cache_data(ttl=30)
+def cached_collection_stats() -> Dict:
+    """Vector collection statistics; the count only changes on ingestion."""
+    return get_chatbot().get_collection_stats()
+
+def invalidate_chats():
+    """Drop cached chat lists and statistics after a write."""
+    # Cache entries are shared across sessions, so clear them for everyone
+    # rather than bumping a per-session key that other sessions can collide with
+    get_chats_page_cached.clear()
+    get_stats_cached.clear()
+
 # ==================== HELPER FUNCTIONS ====================
 
 def create_new_chat():
     """Create a new chat session."""
     chat_id = db.create_chat("Nouvelle conversation")
+    invalidate_chats()
     st.session_state.current_chat_id = chat_id
     st.session_state.messages = []
-    st.session_state.chatbot.clear_history()
+    st.session_state.history = new_history()
     return chat_id
 
 def load_chat(chat_id: int):
     """Load an existing chat."""
     st.session_state.current_chat_id = chat_id
+    # Sources are decoded on first access, i.e. only when rendered
     st.session_state.messages = db.get_chat_messages(chat_id)
-    st.session_state.chatbot.load_history_from_messages(st.session_state.messages)
+    st.session_state.history = history_from_messages(
+        db.get_messages_minimal(chat_id, MAX_HISTORY_MESSAGES)
+    )
+
+def reset_chat_page():
+    """Go back to the first page of the chat list."""
+    st.session_state.chat_page_offset = 0
+
+def render_sources(sources: List[Dict]) -> str:
+    """Build the HTML for all source cards, emitted with a single st.markdown call."""
+    cards = []
+    for source in sources:
+        fields = defaultdict(lambda: 'N/A', source)
+        fields['relevance'] = _RELEVANCE_TPL.format(source['relevance']) if source.get('relevance') else ""
+        cards.append(_SRC_TPL.format_map(fields))
+    return "\n".join(cards)
+
+def handle_user_query(query: str):
+    """Answer a user query: render the exchange, then persist it in one transaction."""
+    chat_id = st.session_state.current_chat_id
+    
+    # Display user message
+    with st.chat_message("user", avatar="🧑"):
+        st.markdown(query)
+    
+    # Get and display bot response
+    with st.chat_message("assistant", avatar="🏛️"):
+        with st.spinner("🔍 Recherche en cours..."):
+            response, stream = st.session_state.chatbot.answer_stream(
+                query, history=st.session_state.history
+            )
+        
+        # Tokens are rendered as Ollama produces them. A rerun or Stop raises out
+        # of here: nothing below runs, so an interrupted exchange is not recorded
+        # anywhere (session, history or database)
+        answer = st.write_stream(stream)
+        
+        # A failure after partial output is shown beside the answer, not saved in it
+        if response.error and answer != response.error:
+            st.warning(response.error)
+        
+        if response.sources and st.session_state.show_sources:
+            with st.expander("📚 Sources utilisées", expanded=False):
+                st.markdown(render_sources(response.sources), unsafe_allow_html=True)
+        
+        # Show response stats
+        if response.response_time_ms > 0:
+            st.caption(f"⚡ Réponse en {response.response_time_ms}ms")
+    
+    # Written once the stream is done so no write lock is held during generation
+    with db.transaction():
+        # Checked under the write lock, against what is actually stored
+        is_first_message = not db.get_messages_minimal(chat_id, 1)
+        db.add_message(chat_id, "user", query)
+        if is_first_message:
+            title = query[:50] + "..." if len(query) > 50 else query
+            db.update_chat_title(chat_id, title)
+        db.add_message(
+            chat_id, 
+            "assistant", 
+            answer, 
+            response.sources,
+            tokens_used=response.tokens_used,
+            response_time_ms=response.response_time_ms
+        )
+    
+    # Session state mirrors the database: only committed exchanges are kept
+    st.session_state.messages.extend([
+        {"role": "user", "content": query},
+        {"role": "assistant", "content": answer, "sources": response.sources},
+    ])
+    invalidate_chats()
 
 def format_time(timestamp_str: str) -> str:
     """Format timestamp for display."""
@@ -119,7 +236,9 @@ def truncate_title(title: str, max_len: int = 30) -> str:
 
 # ==================== SIDEBAR ====================
 
-with st.sidebar:
+@st.fragment
+def render_sidebar():
+    """Sidebar content; its own widgets rerun only this fragment, not the chat."""
     st.markdown('<p class="sidebar-title">🏛️ Patrimoine Tunisien</p>', unsafe_allow_html=True)
     
     # New chat button
@@ -130,51 +249,61 @@ with st.sidebar:
             st.rerun()
     with col2:
         if st.button("🔄", help="Rafraîchir"):
+            invalidate_chats()
             st.rerun()
     
     st.divider()
     
     # Search in history
-    search_query = st.text_input("🔍 Rechercher", placeholder="Rechercher dans l'historique...")
+    # Inside a form, typing does not rerun the app; the filter applies on submit
+    with st.form("search_form", clear_on_submit=False):
+        search_input = st.text_input("🔍 Rechercher", placeholder="Rechercher dans l'historique...")
+        if st.form_submit_button("Rechercher", use_container_width=True):
+            st.session_state.chat_search = search_input.strip()
+            reset_chat_page()
+    search_query = st.session_state.chat_search
     
     # Chat list
     st.markdown("### 💬 Conversations")
     
-    chats = db.get_all_chats()
+    # Filtering and pagination happen in SQL; each loaded page is cached separately
+    chats = []
+    has_more = False
+    for offset in range(0, st.session_state.chat_page_offset + CHATS_PAGE_SIZE, CHATS_PAGE_SIZE):
+        page = get_chats_page_cached(search_query or None, offset)
+        chats.extend(page)
+        has_more = len(page) == CHATS_PAGE_SIZE
     
     if chats:
-        for chat in chats:
-            is_current = chat['id'] == st.session_state.current_chat_id
-            
-            # Filter by search
-            if search_query and search_query.lower() not in chat['title'].lower():
-                continue
-            
-            col1, col2 = st.columns([5, 1])
-            
-            with col1:
-                icon = "📌" if is_current else "💭"
-                btn_type = "primary" if is_current else "secondary"
-                title = truncate_title(chat['title'])
-                msg_count = chat.get('message_count', 0)
-                
-                if st.button(
-                    f"{icon} {title}", 
-                    key=f"chat_{chat['id']}", 
-                    use_container_width=True,
-                    type=btn_type if is_current else "secondary"
-                ):
-                    load_chat(chat['id'])
-                    st.rerun()
-            
-            with col2:
-                if st.button("🗑️", key=f"del_{chat['id']}", help="Supprimer"):
-                    db.delete_chat(chat['id'])
-                    if chat['id'] == st.session_state.current_chat_id:
-                        st.session_state.current_chat_id = None
-                        st.session_state.messages = []
-                        st.session_state.chatbot.clear_history()
-                    st.rerun()
+        # One radio for the whole list instead of two buttons per chat
+        titles = {chat['id']: f"💭 {truncate_title(chat['title'])}" for chat in chats}
+        chat_ids = list(titles)
+        current_id = st.session_state.current_chat_id
+        
+        selected = st.radio(
+            "Conversations",
+            options=chat_ids,
+            format_func=titles.get,
+            index=chat_ids.index(current_id) if current_id in titles else None,
+            label_visibility="collapsed"
+        )
+        
+        if selected is not None and selected != current_id:
+            load_chat(selected)
+            st.rerun()
+        
+        if selected is not None and st.button("🗑️ Supprimer la conversation sélectionnée", use_container_width=True):
+            db.delete_chat(selected)
+            invalidate_chats()
+            if selected == st.session_state.current_chat_id:
+                st.session_state.current_chat_id = None
+                st.session_state.messages = []
+                st.session_state.history = new_history()
+            st.rerun()
+        
+        if has_more and st.button("⬇️ Charger plus", use_container_width=True):
+            st.session_state.chat_page_offset += CHATS_PAGE_SIZE
+            st.rerun(scope="fragment")
     else:
         st.info("Aucune conversation. Créez-en une nouvelle!")
     
@@ -182,7 +311,7 @@ with st.sidebar:
     
     # Statistics
     st.markdown("### 📊 Statistiques")
-    stats = db.get_stats()
+    stats = get_stats_cached()
     col_stats = st.columns(2)
     with col_stats[0]:
         st.metric("Conversations", stats.get('total_chats', 0))
@@ -191,7 +320,7 @@ with st.sidebar:
     
     # Collection info
     try:
-        coll_stats = st.session_state.chatbot.get_collection_stats()
+        coll_stats = cached_collection_stats()
         st.metric("Documents indexés", coll_stats.get('document_count', 0))
     except:
         pass
@@ -200,11 +329,15 @@ with st.sidebar:
     
     # Settings
     st.markdown("### ⚙️ Paramètres")
-    st.session_state.show_sources = st.toggle("Afficher les sources", value=True)
+    show_sources = st.toggle("Afficher les sources", value=st.session_state.show_sources)
+    if show_sources != st.session_state.show_sources:
+        # The chat history lives outside this fragment
+        st.session_state.show_sources = show_sources
+        st.rerun()
     
     # Ollama status
     st.markdown("### 🔌 État du système")
-    ollama_status = check_ollama_status()
+    ollama_status = cached_ollama_status()
     
     if ollama_status['status'] == 'online':
         st.markdown('<span class="status-online">● Ollama en ligne</span>', unsafe_allow_html=True)
@@ -232,6 +365,9 @@ with st.sidebar:
         Développé pour explorer les sites archéologiques de Tunisie.
         """)
 
+with st.sidebar:
+    render_sidebar()
+
 # ==================== MAIN CONTENT ====================
 
 # Header
@@ -301,122 +437,20 @@ else:
             st.markdown(message["content"])
             
             # Display sources for assistant messages
-            if message["role"] == "assistant" and message.get("sources") and st.session_state.show_sources:
+            if st.session_state.show_sources and message["role"] == "assistant" and message.get("sources"):
                 with st.expander("📚 Sources utilisées", expanded=False):
-                    for source in message["sources"]:
-                        st.markdown(f"""
-                        <div class="source-card">
-                            <strong>🏛️ {source.get('site', 'N/A')}</strong><br>
-                            📍 {source.get('ville', 'N/A')} | 
-                            📅 {source.get('periode', 'N/A')} |
-                            📖 {source.get('source', 'N/A')}
-                            {f"<br>🎯 Pertinence: {source['relevance']:.0%}" if source.get('relevance') else ""}
-                        </div>
-                        """, unsafe_allow_html=True)
+                    st.markdown(render_sources(message["sources"]), unsafe_allow_html=True)
     
     # Handle pending question from examples
-    if hasattr(st.session_state, 'pending_question') and st.session_state.pending_question:
+    if st.session_state.get('pending_question'):
         query = st.session_state.pending_question
         st.session_state.pending_question = None
-        
-        # Process the question
-        st.session_state.messages.append({"role": "user", "content": query})
-        db.add_message(st.session_state.current_chat_id, "user", query)
-        
-        if len(st.session_state.messages) == 1:
-            title = query[:50] + "..." if len(query) > 50 else query
-            db.update_chat_title(st.session_state.current_chat_id, title)
-        
-        with st.chat_message("user", avatar="🧑"):
-            st.markdown(query)
-        
-        with st.chat_message("assistant", avatar="🏛️"):
-            with st.spinner("🔍 Recherche en cours..."):
-                answer, sources, tokens, response_time = st.session_state.chatbot.answer(query)
-            
-            st.markdown(answer)
-            
-            if sources and st.session_state.show_sources:
-                with st.expander("📚 Sources utilisées", expanded=False):
-                    for source in sources:
-                        st.markdown(f"""
-                        <div class="source-card">
-                            <strong>🏛️ {source.get('site', 'N/A')}</strong><br>
-                            📍 {source.get('ville', 'N/A')} | 
-                            📅 {source.get('periode', 'N/A')} |
-                            📖 {source.get('source', 'N/A')}
-                        </div>
-                        """, unsafe_allow_html=True)
-        
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": answer,
-            "sources": sources
-        })
-        db.add_message(
-            st.session_state.current_chat_id, 
-            "assistant", 
-            answer, 
-            sources,
-            tokens_used=tokens,
-            response_time_ms=response_time
-        )
+        handle_user_query(query)
         st.rerun()
     
     # Chat input
     if query := st.chat_input("Posez votre question sur le patrimoine tunisien..."):
-        # Add user message
-        st.session_state.messages.append({"role": "user", "content": query})
-        db.add_message(st.session_state.current_chat_id, "user", query)
-        
-        # Update title with first message
-        if len(st.session_state.messages) == 1:
-            title = query[:50] + "..." if len(query) > 50 else query
-            db.update_chat_title(st.session_state.current_chat_id, title)
-        
-        # Display user message
-        with st.chat_message("user", avatar="🧑"):
-            st.markdown(query)
-        
-        # Get and display bot response
-        with st.chat_message("assistant", avatar="🏛️"):
-            with st.spinner("🔍 Recherche en cours..."):
-                answer, sources, tokens, response_time = st.session_state.chatbot.answer(query)
-            
-            st.markdown(answer)
-            
-            # Display sources
-            if sources and st.session_state.show_sources:
-                with st.expander("📚 Sources utilisées", expanded=False):
-                    for source in sources:
-                        st.markdown(f"""
-                        <div class="source-card">
-                            <strong>🏛️ {source.get('site', 'N/A')}</strong><br>
-                            📍 {source.get('ville', 'N/A')} | 
-                            📅 {source.get('periode', 'N/A')} |
-                            📖 {source.get('source', 'N/A')}
-                            {f"<br>🎯 Pertinence: {source['relevance']:.0%}" if source.get('relevance') else ""}
-                        </div>
-                        """, unsafe_allow_html=True)
-            
-            # Show response stats
-            if response_time > 0:
-                st.caption(f"⚡ Réponse en {response_time}ms")
-        
-        # Save to session and database
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": answer,
-            "sources": sources
-        })
-        db.add_message(
-            st.session_state.current_chat_id, 
-            "assistant", 
-            answer, 
-            sources,
-            tokens_used=tokens,
-            response_time_ms=response_time
-        )
+        handle_user_query(query)
 
 # ==================== FOOTER ====================
 
@@ -4,12 +4,15 @@ Uses SQLite for persistent storage of conversations.
 """
 
 import sqlite3
-import json
+import orjson
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator, Tuple
 from pathlib import Path
 
 DB_PATH = Path("data/chat_history.db")
+SCHEMA_VERSION = 2
 
 
 class ChatDatabase:
@@ -17,53 +20,134 @@ class ChatDatabase:
     
     def __init__(self, db_path: str = None):
         self.db_path = db_path or str(DB_PATH)
+        self._local = threading.local()
         self._ensure_directory()
         self._init_db()
-        self._migrate_schema()  # Add migration step
+        self._migrate_schema()
     
     def _ensure_directory(self):
         """Ensure the database directory exists."""
         Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
     
     def _get_connection(self) -> sqlite3.Connection:
-        """Get database connection with row factory."""
-        conn = sqlite3.connect(self.db_path)
+        """Get this thread's persistent connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        
+        # Autocommit mode: write methods open their own transactions
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -20000")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        # LIKE only ignores ASCII case; casefold() matches accented titles too
+        conn.create_function("casefold", 1, _casefold, deterministic=True)
+        self._local.conn = conn
         return conn
     
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run statements in one write transaction; nested calls join the outer one."""
+        conn = self._get_connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    def close(self):
+        """Close this thread's connection, if any."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+    
     def _init_db(self):
         """Initialize database schema."""
-        with self._get_connection() as conn:
-            conn.executescript("""
-                CREATE TABLE IF NOT EXISTS chats (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    title TEXT NOT NULL DEFAULT 'Nouvelle conversation',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_archived INTEGER DEFAULT 0,
-                    metadata TEXT
-                );
-                
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL,
-                    role TEXT NOT NULL CHECK(role IN ('user', 'assistant', 'system')),
-                    content TEXT NOT NULL,
-                    sources TEXT,
-                    tokens_used INTEGER DEFAULT 0,
-                    response_time_ms INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
-                );
-                
-                CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id);
-                CREATE INDEX IF NOT EXISTS idx_chats_updated ON chats(updated_at DESC);
-            """)
+        conn = self._get_connection()
+        # WAL is persistent in the database file: readers no longer block on writes
+        conn.execute("PRAGMA journal_mode = WAL")
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone() is not None
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL DEFAULT 'Nouvelle conversation',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_archived INTEGER DEFAULT 0,
+                metadata TEXT
+            );
+            
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                role TEXT NOT NULL CHECK(role IN ('user', 'assistant', 'system')),
+                content TEXT NOT NULL,
+                sources BLOB,
+                tokens_used INTEGER DEFAULT 0,
+                response_time_ms INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+            );
+            
+            -- (chat_id, created_at) serves both the chat filter and the ORDER BY
+            DROP INDEX IF EXISTS idx_messages_chat_id;
+            CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages(chat_id, created_at);
+            CREATE INDEX IF NOT EXISTS idx_chats_updated ON chats(updated_at DESC);
+            
+            -- Bump the chat's updated_at in the same transaction as the message insert
+            CREATE TRIGGER IF NOT EXISTS trg_msg_bump AFTER INSERT ON messages
+            BEGIN
+                UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.chat_id;
+            END;
+            
+            -- Full-text index over message content, kept in sync by triggers
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content,
+                content='messages',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            );
+            
+            CREATE TRIGGER IF NOT EXISTS trg_msg_fts_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (NEW.id, NEW.content);
+            END;
+            
+            CREATE TRIGGER IF NOT EXISTS trg_msg_fts_delete AFTER DELETE ON messages
+            BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            END;
+            
+            CREATE TRIGGER IF NOT EXISTS trg_msg_fts_update AFTER UPDATE OF content ON messages
+            BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+                INSERT INTO messages_fts(rowid, content) VALUES (NEW.id, NEW.content);
+            END;
+        """)
+        
+        if not has_fts:
+            # Index messages written before the FTS table existed
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
     
     def _migrate_schema(self):
         """Migrate old database schema to new version."""
-        with self._get_connection() as conn:
+        conn = self._get_connection()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        
+        with self.transaction() as conn:
             cursor = conn.cursor()
             
             # Get existing columns in chats table
@@ -72,11 +156,9 @@ class ChatDatabase:
             
             # Add missing columns to chats table
             if 'is_archived' not in chat_columns:
-                print("🔄 Migration: Adding is_archived column to chats table...")
                 conn.execute("ALTER TABLE chats ADD COLUMN is_archived INTEGER DEFAULT 0")
             
             if 'metadata' not in chat_columns:
-                print("🔄 Migration: Adding metadata column to chats table...")
                 conn.execute("ALTER TABLE chats ADD COLUMN metadata TEXT")
             
             # Get existing columns in messages table
@@ -85,21 +167,18 @@ class ChatDatabase:
             
             # Add missing columns to messages table
             if 'tokens_used' not in message_columns:
-                print("🔄 Migration: Adding tokens_used column to messages table...")
                 conn.execute("ALTER TABLE messages ADD COLUMN tokens_used INTEGER DEFAULT 0")
             
             if 'response_time_ms' not in message_columns:
-                print("🔄 Migration: Adding response_time_ms column to messages table...")
                 conn.execute("ALTER TABLE messages ADD COLUMN response_time_ms INTEGER DEFAULT 0")
             
-            conn.commit()
-            print("✅ Database schema migration completed!")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     
     # ==================== CHAT OPERATIONS ====================
     
     def create_chat(self, title: str = "Nouvelle conversation") -> int:
         """Create a new chat session."""
-        with self._get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.execute(
                 "INSERT INTO chats (title) VALUES (?)", 
                 (title,)
@@ -108,12 +187,11 @@ class ChatDatabase:
     
     def get_chat(self, chat_id: int) -> Optional[Dict[str, Any]]:
         """Get a single chat by ID."""
-        with self._get_connection() as conn:
-            row = conn.execute(
-                "SELECT * FROM chats WHERE id = ?", 
-                (chat_id,)
-            ).fetchone()
-            return dict(row) if row else None
+        row = self._get_connection().execute(
+            "SELECT * FROM chats WHERE id = ?", 
+            (chat_id,)
+        ).fetchone()
+        return dict(row) if row else None
     
     def get_all_chats(self, include_archived: bool = False) -> List[Dict[str, Any]]:
         """Get all chats ordered by most recent."""
@@ -126,13 +204,35 @@ class ChatDatabase:
             ORDER BY c.updated_at DESC
         """.format("" if include_archived else "WHERE c.is_archived = 0")
         
-        with self._get_connection() as conn:
-            rows = conn.execute(query).fetchall()
-            return [dict(row) for row in rows]
+        rows = self._get_connection().execute(query).fetchall()
+        return [dict(row) for row in rows]
+    
+    def get_chats_page(
+        self, 
+        search: Optional[str] = None, 
+        limit: int = 50, 
+        offset: int = 0
+    ) -> List[Dict[str, Any]]:
+        """Get one page of active chats, most recent first, optionally filtered by title."""
+        pattern = None
+        if search:
+            escaped = search.casefold().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            pattern = f"%{escaped}%"
+        
+        # Counting per row keeps the aggregation bounded to the page
+        rows = self._get_connection().execute("""
+            SELECT c.*, 
+                   (SELECT COUNT(*) FROM messages m WHERE m.chat_id = c.id) as message_count
+            FROM chats c
+            WHERE c.is_archived = 0 AND (? IS NULL OR casefold(c.title) LIKE ? ESCAPE '\\')
+            ORDER BY c.updated_at DESC
+            LIMIT ? OFFSET ?
+        """, (pattern, pattern, limit, offset)).fetchall()
+        return [dict(row) for row in rows]
     
     def update_chat_title(self, chat_id: int, title: str):
         """Update chat title."""
-        with self._get_connection() as conn:
+        with self.transaction() as conn:
             conn.execute(
                 "UPDATE chats SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
                 (title[:100], chat_id)
@@ -140,7 +240,7 @@ class ChatDatabase:
     
     def archive_chat(self, chat_id: int):
         """Archive a chat instead of deleting."""
-        with self._get_connection() as conn:
+        with self.transaction() as conn:
             conn.execute(
                 "UPDATE chats SET is_archived = 1, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
                 (chat_id,)
@@ -148,12 +248,12 @@ class ChatDatabase:
     
     def delete_chat(self, chat_id: int):
         """Permanently delete a chat and all its messages."""
-        with self._get_connection() as conn:
+        with self.transaction() as conn:
             conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
     
     def delete_all_chats(self):
         """Delete all chats and messages."""
-        with self._get_connection() as conn:
+        with self.transaction() as conn:
             conn.execute("DELETE FROM messages")
             conn.execute("DELETE FROM chats")
     
@@ -169,98 +269,130 @@ class ChatDatabase:
         response_time_ms: int = 0
     ) -> int:
         """Add a message to a chat."""
-        sources_json = json.dumps(sources, ensure_ascii=False) if sources else None
+        sources_blob = orjson.dumps(sources) if sources else None
         
-        with self._get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.execute("""
                 INSERT INTO messages (chat_id, role, content, sources, tokens_used, response_time_ms)
                 VALUES (?, ?, ?, ?, ?, ?)
-            """, (chat_id, role, content, sources_json, tokens_used, response_time_ms))
-            
-            conn.execute(
-                "UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (chat_id,)
-            )
+            """, (chat_id, role, content, sources_blob, tokens_used, response_time_ms))
             return cursor.lastrowid
     
     def get_messages(self, chat_id: int, limit: int = None) -> List[Dict[str, Any]]:
-        """Get all messages for a chat."""
+        """Get all messages for a chat. Sources are decoded on first access."""
         query = """
             SELECT * FROM messages 
             WHERE chat_id = ? 
-            ORDER BY created_at ASC
+            ORDER BY created_at ASC, id ASC
         """
         if limit:
             query += f" LIMIT {limit}"
         
-        with self._get_connection() as conn:
-            rows = conn.execute(query, (chat_id,)).fetchall()
-            messages = []
-            for row in rows:
-                msg = dict(row)
-                if msg['sources']:
-                    try:
-                        msg['sources'] = json.loads(msg['sources'])
-                    except json.JSONDecodeError:
-                        msg['sources'] = []
-                messages.append(msg)
-            return messages
+        conn = self._get_connection()
+        rows = conn.execute(query, (chat_id,)).fetchall()
+        return [_MsgRow(row) for row in rows]
+    
+    def get_messages_minimal(self, chat_id: int, limit: int = None) -> List[Tuple[str, str]]:
+        """Get (role, content) rows for a chat, optionally only the last `limit`."""
+        cursor = self._get_connection().cursor()
+        cursor.row_factory = None
+        if limit:
+            rows = cursor.execute("""
+                SELECT role, content FROM messages 
+                WHERE chat_id = ? 
+                ORDER BY created_at DESC, id DESC 
+                LIMIT ?
+            """, (chat_id, limit)).fetchall()
+            rows.reverse()
+            return rows
+        return cursor.execute("""
+            SELECT role, content FROM messages 
+            WHERE chat_id = ? 
+            ORDER BY created_at ASC, id ASC
+        """, (chat_id,)).fetchall()
     
     def get_recent_messages(self, chat_id: int, count: int = 10) -> List[Dict[str, Any]]:
         """Get the most recent messages for context."""
         query = """
-            SELECT * FROM (
-                SELECT * FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT ?
-            ) ORDER BY created_at ASC
+            SELECT * FROM messages 
+            WHERE chat_id = ? 
+            ORDER BY created_at DESC, id DESC 
+            LIMIT ?
         """
-        with self._get_connection() as conn:
-            rows = conn.execute(query, (chat_id, count)).fetchall()
-            messages = []
-            for row in rows:
-                msg = dict(row)
-                if msg['sources']:
-                    try:
-                        msg['sources'] = json.loads(msg['sources'])
-                    except json.JSONDecodeError:
-                        msg['sources'] = []
-                messages.append(msg)
-            return messages
+        conn = self._get_connection()
+        rows = conn.execute(query, (chat_id, count)).fetchall()
+        return [_MsgRow(row) for row in reversed(rows)]
     
     # ==================== STATISTICS ====================
     
     def get_stats(self) -> Dict[str, Any]:
         """Get database statistics."""
-        with self._get_connection() as conn:
-            stats = {}
-            stats['total_chats'] = conn.execute(
-                "SELECT COUNT(*) FROM chats WHERE is_archived = 0"
-            ).fetchone()[0]
-            stats['archived_chats'] = conn.execute(
-                "SELECT COUNT(*) FROM chats WHERE is_archived = 1"
-            ).fetchone()[0]
-            stats['total_messages'] = conn.execute(
-                "SELECT COUNT(*) FROM messages"
-            ).fetchone()[0]
-            stats['total_tokens'] = conn.execute(
-                "SELECT COALESCE(SUM(tokens_used), 0) FROM messages"
-            ).fetchone()[0]
-            return stats
+        conn = self._get_connection()
+        stats = {}
+        stats['total_chats'] = conn.execute(
+            "SELECT COUNT(*) FROM chats WHERE is_archived = 0"
+        ).fetchone()[0]
+        stats['archived_chats'] = conn.execute(
+            "SELECT COUNT(*) FROM chats WHERE is_archived = 1"
+        ).fetchone()[0]
+        stats['total_messages'] = conn.execute(
+            "SELECT COUNT(*) FROM messages"
+        ).fetchone()[0]
+        stats['total_tokens'] = conn.execute(
+            "SELECT COALESCE(SUM(tokens_used), 0) FROM messages"
+        ).fetchone()[0]
+        return stats
     
     def search_messages(self, query: str, limit: int = 20) -> List[Dict[str, Any]]:
-        """Search through message content."""
-        with self._get_connection() as conn:
-            rows = conn.execute("""
-                SELECT m.*, c.title as chat_title
-                FROM messages m
-                JOIN chats c ON m.chat_id = c.id
-                WHERE m.content LIKE ?
-                ORDER BY m.created_at DESC
-                LIMIT ?
-            """, (f"%{query}%", limit)).fetchall()
-            return [dict(row) for row in rows]
+        """Search through message content using the full-text index."""
+        # Quote each term so user input is never parsed as FTS syntax; match as prefixes
+        terms = query.split()
+        if not terms:
+            return []
+        match = " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+        
+        conn = self._get_connection()
+        rows = conn.execute("""
+            SELECT m.*, c.title as chat_title
+            FROM messages_fts f
+            JOIN messages m ON m.id = f.rowid
+            JOIN chats c ON m.chat_id = c.id
+            WHERE messages_fts MATCH ?
+            ORDER BY f.rank
+            LIMIT ?
+        """, (match, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+
+def _casefold(value: Optional[str]) -> Optional[str]:
+    """Unicode-aware case folding, registered as the SQL function casefold()."""
+    return value.casefold() if value is not None else None
+
+
+def load_sources(value: Any) -> List[Dict]:
+    """Decode a message's sources, which may still be the raw JSON column value."""
+    if not value:
+        return []
+    if not isinstance(value, (bytes, str)):
+        return value
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return []
+
+
+class _MsgRow(dict):
+    """Message row whose 'sources' column is decoded on first access."""
+    
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if key == 'sources' and isinstance(value, (bytes, str)):
+            value = load_sources(value)
+            super().__setitem__(key, value)
+        return value
+    
+    def get(self, key, default=None):
+        return self[key] if key in self else default
 
 
 # Global database instance
@@ -269,15 +401,24 @@ db = ChatDatabase()
 
 # ==================== CONVENIENCE FUNCTIONS ====================
 
+def transaction():
+    return db.transaction()
+
 def create_chat(title: str = "Nouvelle conversation") -> int:
     return db.create_chat(title)
 
 def get_all_chats(include_archived: bool = False) -> List[Dict[str, Any]]:
     return db.get_all_chats(include_archived)
 
+def get_chats_page(search: Optional[str] = None, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
+    return db.get_chats_page(search, limit, offset)
+
 def get_chat_messages(chat_id: int) -> List[Dict[str, Any]]:
     return db.get_messages(chat_id)
 
+def get_messages_minimal(chat_id: int, limit: int = None) -> List[Tuple[str, str]]:
+    return db.get_messages_minimal(chat_id, limit)
+
 def add_message(chat_id: int, role: str, content: str, sources: Optional[List[Dict]] = None, **kwargs) -> int:
     return db.add_message(chat_id, role, content, sources, **kwargs)
 
@@ -3,46 +3,64 @@ Data Ingestion Module for RAG Chatbot.
 Processes corpus.jsonl and indexes documents into ChromaDB.
 """
 
-import json
+import gc
 import os
-import re
 import sys
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
+import numpy as np
+import orjson
 import chromadb
+from rag import get_embedder, EMBEDDING_MODEL_NAME
 
 # ==================== CONFIGURATION ====================
 
 DATA_PROCESSED = Path("data/processed/corpus.jsonl")
 CHROMA_PERSIST_DIR = "data/chroma_db"
 COLLECTION_NAME = "sites_archeologiques_tunisie"
-EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
 # Chunking parameters
 CHUNK_WORD_TARGET = 200
 CHUNK_OVERLAP_WORDS = 30
 MIN_CHUNK_WORDS = 15
 
+# Streaming parameters: documents read per window, chunks buffered before a flush
+READ_WINDOW_DOCS = 2048
+FLUSH_CHUNKS = 10000
+INSERT_BATCH_SIZE = 5000
+
+# HNSW bulk-load settings: apply each insert batch to the graph in one go and
+# persist the index every HNSW_SYNC_THRESHOLD vectors instead of every 1000
+HNSW_SYNC_THRESHOLD = 20000
+
+# Below this many documents, worker startup costs more than it saves
+PARALLEL_MIN_DOCS = 256
+
 # ==================== UTILITIES ====================
 
-_sentence_split_re = re.compile(r'(?<=[.!?।。!?])\s+')
+# A word ending with one of these closes a sentence
+_SENTENCE_END_CHARS = frozenset('.!?।。')
 
 
-def read_corpus(path: Path) -> List[Dict]:
-    """Read JSONL corpus file."""
-    docs = []
-    with open(path, "r", encoding="utf-8") as f:
+def iter_corpus(path: Path) -> Iterator[Dict]:
+    """Stream documents from a JSONL corpus file, one line at a time."""
+    # Binary mode: orjson parses the UTF-8 bytes directly, surrounding whitespace included
+    with open(path, "rb") as f:
         for line_num, line in enumerate(f, 1):
-            line = line.strip()
-            if not line:
+            if line.isspace():
                 continue
             try:
-                docs.append(json.loads(line))
-            except json.JSONDecodeError as e:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError as e:
                 print(f"⚠️ Ligne {line_num}: Erreur JSON - {e}")
-    return docs
+
+
+def read_corpus(path: Path) -> List[Dict]:
+    """Read JSONL corpus file."""
+    return list(iter_corpus(path))
 
 
 def text_to_chunks(
@@ -50,111 +68,160 @@ def text_to_chunks(
     target_words: int = CHUNK_WORD_TARGET, 
     overlap: int = CHUNK_OVERLAP_WORDS
 ) -> List[str]:
-    """Split text into overlapping chunks."""
-    sentences = _sentence_split_re.split(text)
-    chunks = []
-    current_chunk = []
-    current_word_count = 0
+    """Split text into overlapping chunks of whole sentences."""
+    words = text.split()
+    
+    # Word index just past the end of each sentence
+    sentence_ends = [i + 1 for i, word in enumerate(words) if word[-1] in _SENTENCE_END_CHARS]
+    if not sentence_ends or sentence_ends[-1] != len(words):
+        sentence_ends.append(len(words))
     
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence:
+    # Chunks are contiguous word ranges [start, end)
+    spans = []
+    start = end = 0
+    for sentence_end in sentence_ends:
+        if (sentence_end - start) <= target_words or start == end:
+            end = sentence_end
             continue
-            
-        words = sentence.split()
-        word_count = len(words)
         
-        if current_word_count + word_count <= target_words or not current_chunk:
-            current_chunk.append(sentence)
-            current_word_count += word_count
-        else:
-            # Save current chunk
-            chunk_text = " ".join(current_chunk).strip()
-            if chunk_text:
-                chunks.append(chunk_text)
-            
-            # Start new chunk with overlap
-            if overlap > 0:
-                all_words = " ".join(current_chunk).split()
-                overlap_words = all_words[-overlap:] if len(all_words) >= overlap else all_words
-                current_chunk = [" ".join(overlap_words)]
-                current_word_count = len(overlap_words)
-            else:
-                current_chunk = []
-                current_word_count = 0
-            
-            current_chunk.append(sentence)
-            current_word_count += word_count
+        # Save current chunk, then start the next one with overlap
+        spans.append((start, end))
+        start = max(start, end - overlap) if overlap > 0 else end
+        end = sentence_end
     
     # Add remaining chunk
-    if current_chunk:
-        chunk_text = " ".join(current_chunk).strip()
-        if chunk_text:
-            chunks.append(chunk_text)
+    if end > start:
+        spans.append((start, end))
     
     # Filter out very short chunks
-    chunks = [c for c in chunks if len(c.split()) >= MIN_CHUNK_WORDS]
-    
-    return chunks
+    return [" ".join(words[s:e]) for s, e in spans if e - s >= MIN_CHUNK_WORDS]
+
+
+def _format_statut(statut) -> str:
+    if statut == "UNESCO":
+        return "Ce site est inscrit au patrimoine mondial de l'UNESCO."
+    return f"Statut: {statut}."
+
+
+# Rich-text sections in output order: (document field, formatter for its value).
+# Empty or missing fields are skipped.
+_RICH_FIELDS = (
+    ("site", "Site archéologique: {}.".format),
+    ("ville", "Situé à {}, Tunisie.".format),
+    ("description", str),
+    ("periode", "Période historique: {}.".format),
+    ("statut", _format_statut),
+    ("coordonnees", "Coordonnées GPS: {}.".format),
+    ("details", str),
+    ("monuments", lambda monuments: f"Principaux monuments: {', '.join(monuments)}."),
+    ("horaires", "Horaires: {}.".format),
+    ("tarif", "Tarif: {}.".format),
+)
 
 
 def create_rich_text(doc: Dict) -> str:
     """Create enriched text from document for better embeddings."""
-    parts = []
-    
-    # Site name (important for search)
-    site = doc.get('site', '')
-    if site:
-        parts.append(f"Site archéologique: {site}.")
-    
-    # Location
-    ville = doc.get('ville', '')
-    if ville:
-        parts.append(f"Situé à {ville}, Tunisie.")
-    
-    # Main description
-    description = doc.get('description', '')
-    if description:
-        parts.append(description)
-    
-    # Historical period
-    periode = doc.get('periode', '')
-    if periode:
-        parts.append(f"Période historique: {periode}.")
-    
-    # UNESCO status
-    statut = doc.get('statut', '')
-    if statut:
-        if statut == "UNESCO":
-            parts.append("Ce site est inscrit au patrimoine mondial de l'UNESCO.")
-        else:
-            parts.append(f"Statut: {statut}.")
-    
-    # Coordinates
-    coordonnees = doc.get('coordonnees', '')
-    if coordonnees:
-        parts.append(f"Coordonnées GPS: {coordonnees}.")
-    
-    # Additional details
-    details = doc.get('details', '')
-    if details:
-        parts.append(details)
+    return " ".join([
+        render(value)
+        for key, render in _RICH_FIELDS
+        if (value := doc.get(key))
+    ])
+
+
+def _prepare_doc(doc: Dict) -> List[str]:
+    """Build the chunks for one document (runs in worker processes)."""
+    # Create rich text for embedding
+    full_text = create_rich_text(doc)
     
-    # Monuments/attractions
-    monuments = doc.get('monuments', [])
-    if monuments:
-        parts.append(f"Principaux monuments: {', '.join(monuments)}.")
+    if not full_text.strip():
+        return []
     
-    # Practical info
-    horaires = doc.get('horaires', '')
-    if horaires:
-        parts.append(f"Horaires: {horaires}.")
+    # Chunk the text; if no chunks, use the full text as one chunk
+    return text_to_chunks(full_text) or [full_text]
+
+
+def _iter_doc_chunks(docs: Iterable[Dict]) -> Iterator[Tuple[Dict, List[str]]]:
+    """Yield (doc, chunks) pairs, chunking large windows of documents in parallel."""
+    docs = iter(docs)
+    executor = None
+    try:
+        while True:
+            window = list(islice(docs, READ_WINDOW_DOCS))
+            if not window:
+                break
+            
+            if len(window) >= PARALLEL_MIN_DOCS:
+                executor = executor or ProcessPoolExecutor()
+                results = executor.map(_prepare_doc, window, chunksize=32)
+            else:
+                results = map(_prepare_doc, window)
+            yield from zip(window, results)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _doc_metadata(doc: Dict, doc_id) -> Dict:
+    """Build the ChromaDB metadata shared by all chunks of a document."""
+    return {
+        "source_id": str(doc_id),
+        "site": str(doc.get("site", "")),
+        "ville": str(doc.get("ville", "")),
+        "period": str(doc.get("periode", "")),
+        "statut": str(doc.get("statut", "")),
+        "source": str(doc.get("source", "")),
+        "coordonnees": str(doc.get("coordonnees", "")),
+        "keywords": ", ".join(doc.get("keywords", [])),
+    }
+
+
+def _insert_chunks(collection, ids: List[str], texts: List[str], metadatas: List[Dict], embeddings):
+    """Insert embedded chunks into ChromaDB in INSERT_BATCH_SIZE batches."""
+    for i in range(0, len(ids), INSERT_BATCH_SIZE):
+        j = min(i + INSERT_BATCH_SIZE, len(ids))
+        collection.add(
+            ids=ids[i:j],
+            documents=texts[i:j],
+            metadatas=metadatas[i:j],
+            # chromadb 0.4 only accepts lists: convert one batch at a time
+            embeddings=embeddings[i:j].tolist()
+        )
+
+
+def _flush(
+    collection, 
+    embedder, 
+    inserter: ThreadPoolExecutor, 
+    pending: Optional[Future], 
+    ids: List[str], 
+    texts: List[str], 
+    metadatas: List[Dict]
+) -> Future:
+    """
+    Embed buffered chunks in one batched call, then insert them in the background.
+    Waits for the previous insert first, so at most one buffer is in flight.
+    """
+    # Identical chunks (shared boilerplate) are encoded once: map each text to
+    # its position among the unique texts
+    unique_rows: Dict[str, int] = {}
+    rows = [unique_rows.setdefault(text, len(unique_rows)) for text in texts]
     
-    tarif = doc.get('tarif', '')
-    if tarif:
-        parts.append(f"Tarif: {tarif}.")
+    embeddings = embedder.encode(
+        list(unique_rows),
+        batch_size=64,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    # One contiguous (N, dim) float32 block, even when the model runs in fp16;
+    # batches are sliced from it as views
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if len(unique_rows) < len(texts):
+        embeddings = embeddings[rows]
     
-    return " ".join(parts)
+    if pending is not None:
+        pending.result()
+    return inserter.submit(_insert_chunks, collection, ids, texts, metadatas, embeddings)
 
 
 # ==================== MAIN INGESTION ====================
@@ -173,12 +240,7 @@ def main():
     
     # Load embedding model
     print(f"\n📦 Chargement du modèle: {EMBEDDING_MODEL_NAME}")
-    embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
-    
-    # Load corpus
-    print(f"\n📄 Lecture du corpus: {DATA_PROCESSED}")
-    docs = read_corpus(DATA_PROCESSED)
-    print(f"   ✓ {len(docs)} documents chargés")
+    embedder = get_embedder()
     
     # Initialize ChromaDB
     os.makedirs(CHROMA_PERSIST_DIR, exist_ok=True)
@@ -194,79 +256,63 @@ def main():
     
     collection = client.create_collection(
         name=COLLECTION_NAME,
-        metadata={"description": "Sites archéologiques de Tunisie"}
+        metadata={
+            "description": "Sites archéologiques de Tunisie",
+            # Embeddings are unit-normalized: inner product equals cosine similarity
+            "hnsw:space": "ip",
+            "hnsw:batch_size": INSERT_BATCH_SIZE,
+            "hnsw:sync_threshold": HNSW_SYNC_THRESHOLD,
+        }
     )
     print(f"   ✓ Collection '{COLLECTION_NAME}' créée")
     
-    # Prepare data for ingestion
+    # Stream the corpus: chunk, then embed and insert whenever the buffer fills up
+    print(f"\n📄 Lecture du corpus: {DATA_PROCESSED}")
     to_add_ids = []
     to_add_docs = []
     to_add_metadatas = []
-    to_add_embeddings = []
-    
-    global_chunk_id = 0
+    doc_count = 0
+    chunk_count = 0
     
     print(f"\n🔄 Traitement des documents...")
     
-    for doc in tqdm(docs, desc="Indexation"):
-        doc_id = doc.get("id", global_chunk_id)
-        
-        # Create rich text for embedding
-        full_text = create_rich_text(doc)
-        
-        if not full_text.strip():
-            continue
+    # Chroma inserts run on a background thread while the next buffer is encoded
+    with ThreadPoolExecutor(max_workers=1) as inserter:
+        pending = None
         
-        # Chunk the text
-        chunks = text_to_chunks(full_text)
-        
-        if not chunks:
-            # If no chunks, use the full text as one chunk
-            chunks = [full_text]
-        
-        # Compute embeddings
-        embeddings = embedder.encode(chunks, show_progress_bar=False, convert_to_numpy=True)
-        
-        # Prepare for insertion
-        for i, chunk_text in enumerate(chunks):
-            chunk_uid = f"{doc_id}::chunk_{i}"
+        for doc, chunks in tqdm(_iter_doc_chunks(iter_corpus(DATA_PROCESSED)), desc="Indexation", unit="doc"):
+            doc_count += 1
+            if not chunks:
+                continue
             
-            metadata = {
-                "source_id": str(doc_id),
-                "site": str(doc.get("site", "")),
-                "ville": str(doc.get("ville", "")),
-                "period": str(doc.get("periode", "")),
-                "statut": str(doc.get("statut", "")),
-                "source": str(doc.get("source", "")),
-                "coordonnees": str(doc.get("coordonnees", "")),
-                "keywords": ", ".join(doc.get("keywords", [])),
-            }
+            doc_id = doc.get("id", chunk_count + len(to_add_ids))
+            metadata = _doc_metadata(doc, doc_id)
             
-            to_add_ids.append(chunk_uid)
-            to_add_docs.append(chunk_text)
-            to_add_metadatas.append(metadata)
-            to_add_embeddings.append(embeddings[i].tolist())
-            global_chunk_id += 1
-    
-    # Batch insert
-    print(f"\n📥 Insertion de {len(to_add_ids)} chunks...")
-    
-    BATCH_SIZE = 500
-    for i in tqdm(range(0, len(to_add_ids), BATCH_SIZE), desc="Insertion"):
-        j = min(i + BATCH_SIZE, len(to_add_ids))
-        collection.add(
-            ids=to_add_ids[i:j],
-            documents=to_add_docs[i:j],
-            metadatas=to_add_metadatas[i:j],
-            embeddings=to_add_embeddings[i:j]
-        )
+            for i, chunk_text in enumerate(chunks):
+                to_add_ids.append(f"{doc_id}::chunk_{i}")
+                to_add_docs.append(chunk_text)
+                to_add_metadatas.append(dict(metadata))
+            
+            if len(to_add_ids) >= FLUSH_CHUNKS:
+                pending = _flush(collection, embedder, inserter, pending, to_add_ids, to_add_docs, to_add_metadatas)
+                chunk_count += len(to_add_ids)
+                to_add_ids, to_add_docs, to_add_metadatas = [], [], []
+                gc.collect()
+        
+        if to_add_ids:
+            print(f"\n📥 Insertion de {len(to_add_ids)} chunks...")
+            pending = _flush(collection, embedder, inserter, pending, to_add_ids, to_add_docs, to_add_metadatas)
+            chunk_count += len(to_add_ids)
+        
+        if pending is not None:
+            pending.result()
     
     # Summary
     print("\n" + "=" * 60)
     print("✅ INGESTION TERMINÉE")
     print("=" * 60)
-    print(f"   📄 Documents traités: {len(docs)}")
-    print(f"   📦 Chunks créés: {len(to_add_ids)}")
+    print(f"   📄 Documents traités: {doc_count}")
+    print(f"   📦 Chunks créés: {chunk_count}")
     print(f"   🗄️ Base de données: {CHROMA_PERSIST_DIR}")
     print(f"   📚 Collection: {COLLECTION_NAME}")
     print("\n💡 Lancez l'application avec: streamlit run app.py")
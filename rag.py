@@ -6,10 +6,13 @@ Handles document retrieval and LLM-based response generation.
 import chromadb
 from sentence_transformers import SentenceTransformer
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
 import re
-from typing import Tuple, List, Dict, Optional
+from collections import deque
+from itertools import islice
+from typing import Tuple, List, Dict, Optional, Iterator, Deque
 from dataclasses import dataclass
 
 # ==================== CONFIGURATION ====================
@@ -20,13 +23,43 @@ EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
 # Ollama configuration
 LLM_MODEL = "llama3"
-OLLAMA_API_URL = "http://localhost:11434/api/chat"
+OLLAMA_BASE_URL = "http://localhost:11434"
+OLLAMA_API_URL = f"{OLLAMA_BASE_URL}/api/chat"
 OLLAMA_TIMEOUT = 120
 
 # RAG parameters
 DEFAULT_TOP_K = 5
 MAX_HISTORY_MESSAGES = 6
 MAX_INPUT_LENGTH = 500
+QUERY_CACHE_SIZE = 256
+
+# System prompt, identical for every request
+_SYSTEM_PROMPT = """Tu es un assistant expert spécialisé sur les sites archéologiques de Tunisie.
+
+RÈGLES IMPORTANTES:
+1. Réponds UNIQUEMENT avec les informations du CONTEXTE fourni
+2. Si l'information n'est pas dans le contexte, dis clairement: "Je n'ai pas cette information dans ma base de données."
+3. Ne jamais inventer ou supposer des informations
+4. Réponds en français de manière claire et professionnelle
+5. Structure tes réponses avec des paragraphes si nécessaire
+6. Mentionne les sources (sites) quand tu donnes des informations
+7. Si on te demande des coordonnées ou localisations, fournis-les si disponibles"""
+_SYSTEM_MSG = {"role": "system", "content": _SYSTEM_PROMPT}
+
+
+_EMBEDDER: Optional[SentenceTransformer] = None
+
+
+def get_embedder() -> SentenceTransformer:
+    """Load the embedding model once per process and reuse it."""
+    global _EMBEDDER
+    if _EMBEDDER is None:
+        embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        if embedder.device.type == "cuda":
+            # Half precision halves weight/activation bandwidth on GPU
+            embedder.half()
+        _EMBEDDER = embedder
+    return _EMBEDDER
 
 
 @dataclass
@@ -45,7 +78,8 @@ class RAGChatbot:
     def __init__(self):
         self._init_chroma()
         self._init_embedder()
-        self.conversation_history: List[Dict] = []
+        self._init_http()
+        self.conversation_history: Deque[Dict] = new_history()
     
     def _init_chroma(self):
         """Initialize ChromaDB connection."""
@@ -64,9 +98,17 @@ class RAGChatbot:
     def _init_embedder(self):
         """Initialize the embedding model."""
         try:
-            self.embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+            self.embedder = get_embedder()
         except Exception as e:
             raise RuntimeError(f"Failed to load embedding model: {e}")
+        # Query text -> embedding, oldest entry evicted first
+        self._query_cache: Dict[str, List[float]] = {}
+    
+    def _init_http(self):
+        """Initialize a keep-alive HTTP session for Ollama."""
+        self._http = requests.Session()
+        self._http.headers.update({"Content-Type": "application/json"})
+        self._http.mount(OLLAMA_BASE_URL, HTTPAdapter(pool_connections=4, pool_maxsize=4))
     
     # ==================== INPUT PROCESSING ====================
     
@@ -83,64 +125,65 @@ class RAGChatbot:
     
     def detect_language(self, text: str) -> str:
         """Detect if text is primarily French or Arabic."""
-        arabic_pattern = re.compile(r'[\u0600-\u06FF]')
-        if arabic_pattern.search(text):
+        # Stops at the first character in the Arabic block (U+0600-U+06FF)
+        if any('\u0600' <= char <= '\u06ff' for char in text):
             return "ar"
         return "fr"
     
     # ==================== RETRIEVAL ====================
     
+    def embed_query(self, query: str) -> List[float]:
+        """Embed a query, reusing the result for repeated questions."""
+        embedding = self._query_cache.get(query)
+        if embedding is None:
+            # chromadb 0.4 validates each embedding as a Python list
+            embedding = self.embedder.encode(
+                query, convert_to_numpy=True, normalize_embeddings=True
+            ).tolist()
+            if len(self._query_cache) >= QUERY_CACHE_SIZE:
+                self._query_cache.pop(next(iter(self._query_cache)), None)
+            self._query_cache[query] = embedding
+        return embedding
+    
     def retrieve_documents(self, query: str, top_k: int = DEFAULT_TOP_K) -> Tuple[str, List[Dict]]:
         """Retrieve relevant documents from ChromaDB."""
-        query_embedding = self.embedder.encode([query], convert_to_numpy=True)[0]
-        
         results = self.collection.query(
-            query_embeddings=[query_embedding.tolist()],
+            query_embeddings=[self.embed_query(query)],
             n_results=top_k,
             include=["documents", "metadatas", "distances"]
         )
         
-        context_parts = []
-        sources = []
-        seen_sites = set()
-        
         if not results['documents'] or not results['documents'][0]:
             return "", []
         
-        for i, (doc_text, meta) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
-            context_parts.append(doc_text.strip())
-            
+        documents = results['documents'][0]
+        metadatas = results['metadatas'][0]
+        distances = (results.get('distances') or [[None] * len(documents)])[0]
+        relevances = [round(1 - d, 3) if d is not None else None for d in distances]
+        
+        context_parts = [doc_text.strip() for doc_text in documents]
+        
+        # One source per site, in rank order: the first (best) hit wins
+        sources_by_site = {}
+        for meta, relevance in zip(metadatas, relevances):
             site_name = meta.get("site", "Sans titre")
-            if site_name not in seen_sites:
-                seen_sites.add(site_name)
-                distance = results['distances'][0][i] if results.get('distances') else None
-                sources.append({
-                    "site": site_name,
-                    "source": meta.get("source", "inconnu"),
-                    "ville": meta.get("ville", ""),
-                    "periode": meta.get("period", ""),
-                    "coordonnees": meta.get("coordonnees", ""),
-                    "relevance": round(1 - distance, 3) if distance else None
-                })
+            sources_by_site.setdefault(site_name, {
+                "site": site_name,
+                "source": meta.get("source", "inconnu"),
+                "ville": meta.get("ville", ""),
+                "periode": meta.get("period", ""),
+                "coordonnees": meta.get("coordonnees", ""),
+                "relevance": relevance
+            })
+        sources = list(sources_by_site.values())
         
         context = "\n\n".join(context_parts)
         return context, sources
     
     # ==================== GENERATION ====================
     
-    def build_messages(self, query: str, context: str) -> List[Dict]:
+    def build_messages(self, query: str, context: str, history: Optional[Deque[Dict]] = None) -> List[Dict]:
         """Build the message list for Ollama API."""
-        system_prompt = """Tu es un assistant expert spécialisé sur les sites archéologiques de Tunisie.
-
-RÈGLES IMPORTANTES:
-1. Réponds UNIQUEMENT avec les informations du CONTEXTE fourni
-2. Si l'information n'est pas dans le contexte, dis clairement: "Je n'ai pas cette information dans ma base de données."
-3. Ne jamais inventer ou supposer des informations
-4. Réponds en français de manière claire et professionnelle
-5. Structure tes réponses avec des paragraphes si nécessaire
-6. Mentionne les sources (sites) quand tu donnes des informations
-7. Si on te demande des coordonnées ou localisations, fournis-les si disponibles"""
-
         user_prompt = f"""CONTEXTE (Base de données des sites archéologiques tunisiens):
 {context}
 
@@ -148,9 +191,12 @@ QUESTION: {query}
 
 Réponds de manière précise et informative en te basant uniquement sur le contexte ci-dessus."""
 
-        messages = [{"role": "system", "content": system_prompt}]
+        messages = [_SYSTEM_MSG]
+        
+        if history is None:
+            history = self.conversation_history
         
-        for msg in self.conversation_history[-MAX_HISTORY_MESSAGES:]:
+        for msg in islice(history, max(len(history) - MAX_HISTORY_MESSAGES, 0), None):
             messages.append({
                 "role": msg["role"],
                 "content": msg["content"]
@@ -160,84 +206,137 @@ Réponds de manière précise et informative en te basant uniquement sur le cont
         
         return messages
     
-    def generate_response(self, messages: List[Dict]) -> Tuple[str, int]:
-        """Generate response using Ollama API."""
+    def generate_response(self, messages: List[Dict]) -> Tuple[str, int, int]:
+        """Generate a complete response using Ollama API."""
+        response = RAGResponse(answer="", sources=[])
+        for _ in self.generate_response_stream(messages, response):
+            pass
+        return response.answer, response.tokens_used, response.response_time_ms
+    
+    def generate_response_stream(self, messages: List[Dict], response: RAGResponse) -> Iterator[str]:
+        """Stream response fragments from Ollama API, filling `response` as they arrive."""
         start_time = time.time()
         
         try:
-            response = requests.post(
+            http_response = self._http.post(
                 OLLAMA_API_URL,
                 json={
                     "model": LLM_MODEL,
                     "messages": messages,
-                    "stream": False,
+                    "stream": True,
                     "options": {
                         "temperature": 0.7,
                         "num_predict": 500,
                         "top_p": 0.9
                     }
                 },
+                stream=True,
                 timeout=OLLAMA_TIMEOUT
             )
             
-            response_time = int((time.time() - start_time) * 1000)
+            with http_response:
+                if http_response.status_code == 404:
+                    response.error = f"❌ Modèle '{LLM_MODEL}' non trouvé. Exécutez: ollama pull {LLM_MODEL}"
+                elif http_response.status_code != 200:
+                    response.error = f"❌ Erreur API (code {http_response.status_code})"
+                else:
+                    for line in http_response.iter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        # Ollama reports failures mid-stream as {"error": ...} lines
+                        if 'error' in chunk:
+                            response.error = f"❌ Erreur Ollama: {chunk['error']}"
+                            break
+                        fragment = chunk.get('message', {}).get('content', '')
+                        if fragment:
+                            response.answer += fragment
+                            yield fragment
+                        if chunk.get('done'):
+                            response.tokens_used = chunk.get('eval_count', 0)
+                            break
             
-            if response.status_code == 200:
-                result = response.json()
-                answer = result['message']['content']
-                tokens = result.get('eval_count', 0)
-                return answer, tokens, response_time
-            elif response.status_code == 404:
-                return f"❌ Modèle '{LLM_MODEL}' non trouvé. Exécutez: ollama pull {LLM_MODEL}", 0, response_time
-            else:
-                return f"❌ Erreur API (code {response.status_code})", 0, response_time
+            response.response_time_ms = int((time.time() - start_time) * 1000)
                 
         except requests.exceptions.Timeout:
-            return "⏱️ Délai d'attente dépassé. Le modèle prend trop de temps.", 0, 0
+            response.error = "⏱️ Délai d'attente dépassé. Le modèle prend trop de temps."
         except requests.exceptions.ConnectionError:
-            return "❌ Impossible de se connecter à Ollama. Vérifiez qu'il est lancé avec: ollama serve", 0, 0
+            response.error = "❌ Impossible de se connecter à Ollama. Vérifiez qu'il est lancé avec: ollama serve"
         except Exception as e:
-            return f"❌ Erreur: {str(e)}", 0, 0
+            response.error = f"❌ Erreur: {str(e)}"
+        
+        # With nothing generated the error becomes the answer; otherwise it is
+        # only reported through `response.error`, keeping the partial answer clean
+        if response.error and not response.answer:
+            response.answer = response.error
+            yield response.error
     
     # ==================== MAIN INTERFACE ====================
     
-    def answer(self, query: str, top_k: int = DEFAULT_TOP_K) -> Tuple[str, List[Dict], int, int]:
+    def answer(
+        self, 
+        query: str, 
+        top_k: int = DEFAULT_TOP_K, 
+        history: Optional[Deque[Dict]] = None
+    ) -> Tuple[str, List[Dict], int, int]:
         """
         Main method to answer a query.
+        `history` is updated in place; defaults to the instance's own history.
         Returns: (answer, sources, tokens_used, response_time_ms)
         """
+        response, stream = self.answer_stream(query, top_k, history)
+        for _ in stream:
+            pass
+        return response.answer, response.sources, response.tokens_used, response.response_time_ms
+    
+    def answer_stream(
+        self, 
+        query: str, 
+        top_k: int = DEFAULT_TOP_K, 
+        history: Optional[Deque[Dict]] = None
+    ) -> Tuple[RAGResponse, Iterator[str]]:
+        """
+        Streaming variant of answer().
+        Retrieval runs immediately; generation runs as the iterator is consumed.
+        The returned RAGResponse is complete once the iterator is exhausted.
+        """
         query = self.sanitize_input(query)
         if not query:
-            return "❌ Veuillez entrer une question valide.", [], 0, 0
+            message = "❌ Veuillez entrer une question valide."
+            return RAGResponse(answer=message, sources=[]), iter([message])
         
         context, sources = self.retrieve_documents(query, top_k)
         
         if not context:
-            return "❌ Aucun document trouvé dans la base de données. Exécutez d'abord: python ingest.py", [], 0, 0
+            message = "❌ Aucun document trouvé dans la base de données. Exécutez d'abord: python ingest.py"
+            return RAGResponse(answer=message, sources=[]), iter([message])
         
-        messages = self.build_messages(query, context)
-        answer, tokens, response_time = self.generate_response(messages)
+        if history is None:
+            history = self.conversation_history
         
-        self.conversation_history.append({"role": "user", "content": query})
-        self.conversation_history.append({"role": "assistant", "content": answer})
+        messages = self.build_messages(query, context, history)
+        response = RAGResponse(answer="", sources=sources)
         
-        if len(self.conversation_history) > MAX_HISTORY_MESSAGES * 2:
-            self.conversation_history = self.conversation_history[-MAX_HISTORY_MESSAGES * 2:]
+        def stream() -> Iterator[str]:
+            yield from self.generate_response_stream(messages, response)
+            self._remember(history, query, response.answer)
         
-        return answer, sources, tokens, response_time
+        return response, stream()
+    
+    def _remember(self, history: Deque[Dict], query: str, answer: str):
+        """Append a completed exchange to `history`; the oldest messages fall off."""
+        history.extend((
+            {"role": "user", "content": query},
+            {"role": "assistant", "content": answer},
+        ))
     
     def load_history_from_messages(self, messages: List[Dict]):
         """Load conversation history from database messages."""
-        self.conversation_history = []
-        for msg in messages[-MAX_HISTORY_MESSAGES:]:
-            self.conversation_history.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+        self.conversation_history = history_from_messages(messages)
     
     def clear_history(self):
         """Clear conversation history."""
-        self.conversation_history = []
+        self.conversation_history.clear()
     
     def get_collection_stats(self) -> Dict:
         """Get statistics about the document collection."""
@@ -252,12 +351,29 @@ Réponds de manière précise et informative en te basant uniquement sur le cont
             return {"document_count": 0}
 
 
+def new_history() -> Deque[Dict]:
+    """Create an empty conversation history bounded to the last exchanges."""
+    return deque(maxlen=MAX_HISTORY_MESSAGES * 2)
+
+
+def history_from_messages(messages: List) -> Deque[Dict]:
+    """Build a conversation history from message dicts or (role, content) rows."""
+    history = new_history()
+    for msg in messages[-MAX_HISTORY_MESSAGES:]:
+        if isinstance(msg, dict):
+            role, content = msg["role"], msg["content"]
+        else:
+            role, content = msg
+        history.append({"role": role, "content": content})
+    return history
+
+
 # ==================== HEALTH CHECK ====================
 
 def check_ollama_status() -> Dict:
     """Check if Ollama is running and model is available."""
     try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=5)
+        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
         if response.status_code == 200:
             models = response.json().get("models", [])
             model_names = [m["name"] for m in models]